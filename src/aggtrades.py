@@ -0,0 +1,389 @@
+import json
+import math
+import threading
+import time
+from array import array
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from metaflip import FAST_CYCLE
+
+"""
+Builds 1m candles and volume profiles locally from aggregated trades, either
+streamed from binance or replayed from a recorded file, so the trackers do not
+have to poll klines.
+Trades of the running minute are appended to compact typed arrays, and only
+summarized with numpy when the minute closes or a tick asks for the running
+candle. Candles come out in the REST kline layout, ready for PinkyTracker.feed.
+
+Every aggTrade has a buyer and a seller, `m` tells whether the buyer was the
+maker, otherwise the buyer was the taker and the trade counts as taker volume.
+"""
+KLINE_MS = 60 * 1000
+STREAM_URL = "wss://stream.binance.com:9443"
+TEST_STREAM_URL = "wss://testnet.binance.vision"
+STREAM_TIMEOUT = 60
+QUIET_GRACE_MS = 2000
+PROFILE_RESOLUTION = 1e-4
+
+AGG_TRADE_COLUMNS = [
+    "agg_trade_id",
+    "price",
+    "quantity",
+    "first_trade_id",
+    "last_trade_id",
+    "transact_time",
+    "is_buyer_maker",
+    "is_best_match",
+]
+
+
+def as_text(value) -> str:
+    # klines carry decimals as text, keep the shortest exact float form
+    return repr(float(value))
+
+
+def as_milliseconds(times: np.ndarray) -> np.ndarray:
+    # newer binance dumps stamp trades in microseconds, older ones in millis
+    if times.size and times[0] > 10**14:
+        return times // 1000
+    return times
+
+
+def relative_bin_size(price: float) -> float:
+    """A round bin size of about PROFILE_RESOLUTION of the price."""
+    return 10 ** math.floor(math.log10(max(price, 1e-12) * PROFILE_RESOLUTION))
+
+
+class VolumeProfile:
+    """Volume traded per price level, one bin per tick size, or when the pair
+    has no usable tick size, one bin per PROFILE_RESOLUTION of its price."""
+
+    def __init__(self, bin_size: float = None):
+        self.bin_size = bin_size if bin_size and bin_size > 0 else None
+        self.first_bin = 0
+        self.volume = np.zeros(0)
+        self.taker_volume = np.zeros(0)
+
+    def reserve(self, low: int, high: int):
+        if not self.volume.size:
+            self.first_bin = low
+        last_bin = self.first_bin + self.volume.size - 1
+        if low >= self.first_bin and high <= last_bin:
+            return
+
+        first_bin = min(low, self.first_bin)
+        size = max(high, last_bin) - first_bin + 1
+        offset = self.first_bin - first_bin
+        for name in ("volume", "taker_volume"):
+            values = getattr(self, name)
+            grown = np.zeros(size)
+            grown[offset : offset + values.size] = values
+            setattr(self, name, grown)
+        self.first_bin = first_bin
+
+    def add(self, bins, volume, taker_volume, sign=1):
+        self.reserve(int(bins[0]), int(bins[-1]))
+        index = bins - self.first_bin
+        self.volume[index] += sign * volume
+        self.taker_volume[index] += sign * taker_volume
+
+    def levels(self):
+        """Returns the price, volume and taker volume of every traded level."""
+        traded = np.flatnonzero(self.volume > 1e-12)
+        prices = (self.first_bin + traded) * self.bin_size
+        return prices, self.volume[traded], self.taker_volume[traded]
+
+    def point_of_control(self):
+        if not self.volume.size or self.volume.max() <= 1e-12:
+            return None
+        return (self.first_bin + int(self.volume.argmax())) * self.bin_size
+
+
+class TradeTape:
+    def __init__(self, symbol: str, bin_size: float = None, limit=FAST_CYCLE):
+        self.symbol = symbol
+        self.limit = limit
+
+        self.candles = deque(maxlen=limit)
+        self.profile = VolumeProfile(bin_size)
+        self.profile_parts = deque()
+
+        # the first minute is only seen partially, so it is never emitted
+        self.minute = None
+        self.complete = False
+        self.reset()
+
+    def reset(self):
+        self.prices = array("d")
+        self.quantities = array("d")
+        self.takers = array("b")
+        self.trades = array("q")
+
+    def add(
+        self,
+        trade_time: int,
+        price: float,
+        quantity: float,
+        buyer_is_maker,
+        trades: int = 1,
+    ):
+        minute = trade_time - trade_time % KLINE_MS
+        if self.minute is None or minute > self.minute:
+            self.roll(minute)
+
+        self.prices.append(price)
+        self.quantities.append(quantity)
+        self.takers.append(not buyer_is_maker)
+        self.trades.append(trades)
+
+    def add_batch(self, trade_times, prices, quantities, buyer_is_maker, trades):
+        minutes = trade_times - trade_times % KLINE_MS
+        takers = (~buyer_is_maker.astype(bool)).astype(np.int8)
+        bounds = np.flatnonzero(np.diff(minutes)) + 1
+        for start, end in zip(
+            np.concatenate(([0], bounds)), np.concatenate((bounds, [minutes.size]))
+        ):
+            if self.minute is None or minutes[start] > self.minute:
+                self.roll(int(minutes[start]))
+            self.prices.frombytes(prices[start:end].astype(float).tobytes())
+            self.quantities.frombytes(quantities[start:end].astype(float).tobytes())
+            self.takers.frombytes(takers[start:end].tobytes())
+            self.trades.frombytes(trades[start:end].astype(np.int64).tobytes())
+
+    def roll(self, minute: int):
+        if self.minute is not None and self.prices:
+            if self.complete:
+                self.close_candle()
+            self.complete = True
+        if self.complete and self.candles:
+            self.fill_quiet_minutes(minute)
+
+        self.minute = minute
+        self.reset()
+
+    def fill_quiet_minutes(self, minute: int):
+        for quiet in range(self.candles[-1][0] + KLINE_MS, minute, KLINE_MS):
+            self.candles.append(self.quiet_candle(quiet))
+
+    def quiet_candle(self, minute: int) -> list:
+        close = self.candles[-1][4]
+        candle = [minute, close, close, close, close, "0", minute + KLINE_MS - 1]
+        return candle + ["0", 0, "0", "0", "0"]
+
+    def summarize(self) -> list:
+        prices = np.frombuffer(self.prices, dtype=float)
+        quantities = np.frombuffer(self.quantities, dtype=float)
+        takers = np.frombuffer(self.takers, dtype=np.int8).astype(bool)
+
+        quote = prices * quantities
+        return [
+            self.minute,
+            as_text(prices[0]),
+            as_text(prices.max()),
+            as_text(prices.min()),
+            as_text(prices[-1]),
+            as_text(quantities.sum()),
+            self.minute + KLINE_MS - 1,
+            as_text(quote.sum()),
+            int(np.frombuffer(self.trades, dtype=np.int64).sum()),
+            as_text(quantities[takers].sum()),
+            as_text(quote[takers].sum()),
+            "0",
+        ]
+
+    def close_candle(self):
+        self.candles.append(self.summarize())
+
+        prices = np.frombuffer(self.prices, dtype=float)
+        quantities = np.frombuffer(self.quantities, dtype=float)
+        takers = np.frombuffer(self.takers, dtype=np.int8)
+
+        if self.profile.bin_size is None:
+            self.profile.bin_size = relative_bin_size(float(prices[-1]))
+        bins, where = np.unique(
+            np.rint(prices / self.profile.bin_size).astype(np.int64),
+            return_inverse=True,
+        )
+        volume = np.bincount(where, weights=quantities)
+        taker_volume = np.bincount(where, weights=quantities * takers)
+
+        self.profile.add(bins, volume, taker_volume)
+        self.profile_parts.append((bins, volume, taker_volume))
+        if len(self.profile_parts) > self.limit:
+            self.profile.add(*self.profile_parts.popleft(), sign=-1)
+
+    def klines(self, since: int, limit=FAST_CYCLE, now: int = None):
+        """Returns the candles opened since then, the running one included, or
+        None when the tape does not reach back that far.
+        When given the current time, minutes without trades are filled with
+        flat candles up to now, the way the REST klines would be."""
+        if now is not None and self.minute is not None:
+            current = now - QUIET_GRACE_MS
+            current -= current % KLINE_MS
+            if current > self.minute:
+                self.roll(current)
+
+        if not self.complete:
+            return None
+        first = self.candles[0][0] if self.candles else self.minute
+        if since < first:
+            return None
+
+        rows = [x for x in self.candles if x[0] >= since]
+        if self.prices:
+            rows.append(self.summarize())
+        elif self.candles:
+            rows.append(self.quiet_candle(self.minute))
+        return rows[-limit:]
+
+
+class AggTradeStream:
+    def __init__(
+        self,
+        stream_url=STREAM_URL,
+        limit=FAST_CYCLE,
+        recording=None,
+    ):
+        self.stream_url = stream_url
+        self.limit = limit
+
+        self.tapes = dict()
+        self.lock = threading.Lock()
+        self.socket = None
+        self.dropped = False
+        self.last_message = 0
+        self.recording = open(recording, "at") if recording else None
+
+    @property
+    def alive(self):
+        return time.monotonic() - self.last_message < STREAM_TIMEOUT
+
+    def connect(self):
+        from binance.websocket.spot.websocket_stream import SpotWebsocketStreamClient
+
+        socket = SpotWebsocketStreamClient(
+            stream_url=self.stream_url,
+            on_message=self.on_message,
+            on_ping=self.on_ping,
+            on_close=self.on_drop,
+            on_error=self.on_drop,
+            timeout=STREAM_TIMEOUT,
+        )
+        self.socket, self.dropped = socket, False
+        self.last_message = time.monotonic()
+        # one message for all, binance only accepts a few messages per second
+        if self.tapes:
+            self.socket.subscribe([f"{x.lower()}@aggTrade" for x in self.tapes])
+
+    def check(self):
+        """Reconnects once the connection dropped or went silent, binance
+        drops every connection at least once a day."""
+        if not self.socket or (self.alive and not self.dropped):
+            return
+
+        print("Aggregated trade stream lost, reconnecting.")
+        self.socket.stop()
+        with self.lock:
+            # trades were missed meanwhile, so every tape starts over
+            self.tapes = {
+                symbol: TradeTape(symbol, tape.profile.bin_size, self.limit)
+                for symbol, tape in self.tapes.items()
+            }
+        try:
+            self.connect()
+        except Exception as error:
+            # keeps trying on the next check, meanwhile klines come from REST
+            print(f"Cannot reconnect yet, {error}")
+
+    def subscribe(self, symbol: str, bin_size: float = None):
+        with self.lock:
+            if symbol in self.tapes:
+                return
+            self.tapes[symbol] = TradeTape(symbol, bin_size, self.limit)
+        if self.socket:
+            self.socket.agg_trade(symbol=symbol)
+
+    def unsubscribe(self, symbol: str):
+        with self.lock:
+            self.tapes.pop(symbol, None)
+        if self.socket:
+            self.socket.agg_trade(symbol=symbol, action="UNSUBSCRIBE")
+
+    def on_ping(self, *_):
+        self.last_message = time.monotonic()
+
+    def on_drop(self, *_):
+        self.dropped = True
+
+    def on_message(self, _, message: str):
+        self.last_message = time.monotonic()
+        if self.recording:
+            self.recording.write(message + "\n")
+
+        trade = json.loads(message)
+        if trade.get("e") != "aggTrade":
+            return
+
+        with self.lock:
+            tape = self.tapes.get(trade["s"])
+            if tape:
+                tape.add(
+                    trade["T"],
+                    float(trade["p"]),
+                    float(trade["q"]),
+                    trade["m"],
+                    trade["l"] - trade["f"] + 1,
+                )
+
+    def klines(self, symbol: str, since: int, limit=FAST_CYCLE):
+        if self.socket and (self.dropped or not self.alive):
+            return None
+
+        # replayed tapes keep their own time, live ones follow the clock
+        now = int(time.time() * 1000) if self.socket else None
+        with self.lock:
+            tape = self.tapes.get(symbol)
+            return tape.klines(since, limit, now) if tape else None
+
+    def point_of_control(self, symbol: str):
+        """The most traded price of the closed minutes on the tape, if any."""
+        with self.lock:
+            tape = self.tapes.get(symbol)
+            return tape.profile.point_of_control() if tape else None
+
+    def replay(self, path: str, symbol: str = None, chunksize=1_000_000):
+        """Feeds a recorded file into the tapes, either the JSON lines written
+        while streaming, or a csv of `symbol` aggTrades from data.binance.vision."""
+        if path.endswith(".csv"):
+            with open(path, "rt") as data_file:
+                header = data_file.readline().startswith("agg_trade_id")
+            chunks = pd.read_csv(
+                path,
+                names=AGG_TRADE_COLUMNS,
+                header=0 if header else None,
+                chunksize=chunksize,
+            )
+            for chunk in chunks:
+                with self.lock:
+                    self.tapes[symbol].add_batch(
+                        as_milliseconds(chunk["transact_time"].to_numpy(np.int64)),
+                        chunk["price"].to_numpy(float),
+                        chunk["quantity"].to_numpy(float),
+                        chunk["is_buyer_maker"].to_numpy(bool),
+                        (
+                            chunk["last_trade_id"] - chunk["first_trade_id"] + 1
+                        ).to_numpy(),
+                    )
+        else:
+            with open(path, "rt") as data_file:
+                for line in data_file:
+                    self.on_message(None, line)
+
+    def stop(self):
+        if self.socket:
+            self.socket.stop()
+        if self.recording:
+            self.recording.close()
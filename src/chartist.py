@@ -0,0 +1,167 @@
+import importlib.util
+import multiprocessing
+import os
+import queue
+
+import numpy as np
+
+
+"""
+Charts are rendered by a separate process, so that plotting never delays
+the tick loop. Candles and indicators travel as plain numpy arrays, long
+windows are downsampled before plotting, and rendered charts are cached on
+disk by symbol and last close time.
+mplfinance and matplotlib are optional, they are only imported by the worker.
+"""
+MAX_CANDLES = 240
+CACHED_CHARTS = 3
+CHART_DPI = 100
+
+CHART_INDICATORS = {
+    "vwap": "blueviolet",
+    "vwap_vhigh": "royalblue",
+    "vwap_high": "deepskyblue",
+    "vwap_low": "darkorange",
+    "vwap_vlow": "orangered",
+}
+
+
+def downsample(payload: dict, limit: int = MAX_CANDLES) -> dict:
+    size = payload["close"].size
+    if size <= limit:
+        return payload
+
+    step = -(-size // limit)
+    starts = np.arange(0, size, step)
+    ends = np.minimum(starts + step, size) - 1
+
+    sampled = dict(payload)
+    sampled["time"] = payload["time"][starts]
+    sampled["open"] = payload["open"][starts]
+    sampled["high"] = np.maximum.reduceat(payload["high"], starts)
+    sampled["low"] = np.minimum.reduceat(payload["low"], starts)
+    sampled["close"] = payload["close"][ends]
+    sampled["volume"] = np.add.reduceat(payload["volume"], starts)
+    sampled["indicators"] = {
+        name: values[ends] for name, values in payload["indicators"].items()
+    }
+    return sampled
+
+
+def chart_path(folder: str, symbol: str, close_time: int) -> str:
+    return os.path.join(folder, f"{symbol}_{close_time}.png")
+
+
+def render(payload: dict, folder: str) -> str:
+    import pandas as pd
+    import mplfinance as mpf
+    from matplotlib import pyplot as plt
+
+    payload = downsample(payload)
+    df = pd.DataFrame(
+        {x: payload[x] for x in ("open", "high", "low", "close", "volume")},
+        index=pd.DatetimeIndex(payload["time"]),
+    )
+
+    extras = [
+        mpf.make_addplot(
+            payload["indicators"][name], color=color, panel=0, secondary_y=False
+        )
+        for name, color in CHART_INDICATORS.items()
+        if name in payload["indicators"]
+    ]
+
+    fig, axes = mpf.plot(
+        df,
+        type="candle",
+        addplot=extras,
+        title=payload["title"],
+        figsize=(13, 8),
+        tight_layout=True,
+        style="yahoo",
+        xrotation=0,
+        returnfig=True,
+    )
+
+    for ax in axes:
+        ax.yaxis.tick_left()
+        ax.yaxis.label.set_visible(False)
+        ax.margins(x=0.1, y=0.1, tight=False)
+
+    path = chart_path(folder, payload["symbol"], payload["close_time"])
+    fig.savefig(path, bbox_inches="tight", pad_inches=0.3, dpi=CHART_DPI)
+    plt.close(fig)
+
+    return path
+
+
+def prune(folder: str, symbol: str, keep: int = CACHED_CHARTS):
+    charts = sorted(
+        (x for x in os.listdir(folder) if x.startswith(f"{symbol}_")),
+        key=lambda x: int(x[len(symbol) + 1 : -4]),
+    )
+    for name in charts[:-keep]:
+        os.remove(os.path.join(folder, name))
+
+
+def serve(requests, results, folder: str):
+    missing = [
+        x for x in ("matplotlib", "mplfinance") if importlib.util.find_spec(x) is None
+    ]
+    if missing:
+        results.put((None, None, None, f"charts disabled, missing {missing}"))
+        return
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    while True:
+        payload = requests.get()
+        if payload is None:
+            break
+
+        symbol, close_time = payload["symbol"], payload["close_time"]
+        path = chart_path(folder, symbol, close_time)
+        try:
+            if not os.path.isfile(path):
+                render(payload, folder)
+                prune(folder, symbol)
+            results.put((symbol, close_time, path, None))
+        except Exception as error:
+            error = f"{type(error).__name__}: {error}"
+            results.put((symbol, close_time, None, error))
+
+
+class ChartWorker:
+    def __init__(self, folder="./charts"):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=serve, args=(self.requests, self.results, folder), daemon=True
+        )
+        self.process.start()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def request(self, payload: dict):
+        self.requests.put(payload)
+
+    def collect(self) -> list:
+        """Returns every (symbol, close_time, path, error) ready so far."""
+        ready = list()
+        while True:
+            try:
+                ready.append(self.results.get_nowait())
+            except queue.Empty:
+                return ready
+
+    def stop(self):
+        self.requests.put(None)
+        self.process.join(timeout=5)
@@ -0,0 +1,231 @@
+from collections import namedtuple
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+
+
+"""
+Every indicator declares the columns or other indicators it is computed from.
+Windowed indicators hand their window down to windowed inputs, so the engine
+can address each intermediate as (name, window) and compute it only once per
+run, no matter how many indicators depend on it.
+"""
+SOURCES = ("open", "high", "low", "close", "volume")
+
+Indicator = namedtuple("Indicator", ["name", "inputs", "windowed", "compute"])
+
+REGISTRY = dict()
+
+
+def indicator(name, *inputs, windowed=False):
+    def register(compute):
+        REGISTRY[name] = Indicator(name, inputs, windowed, compute)
+        return compute
+
+    return register
+
+
+def node_key(name, window=None):
+    if name in SOURCES:
+        return name, None
+    if name not in REGISTRY:
+        raise KeyError(f"Unknown indicator {name!r}")
+    return name, window if REGISTRY[name].windowed else None
+
+
+def wilder(series, window):
+    return series.ewm(alpha=1 / window, adjust=False, min_periods=window).mean()
+
+
+# price and volume derivatives
+
+
+@indicator("typical_price", "high", "low", "close")
+def typical_price(high, low, close):
+    return (high + low + close) / 3
+
+
+@indicator("money_flow", "typical_price", "volume")
+def money_flow(typical_price, volume):
+    return typical_price * volume
+
+
+@indicator("true_range", "high", "low", "close")
+def true_range(high, low, close):
+    prev_close = close.shift(1)
+    return pd.concat(
+        [high - low, (high - prev_close).abs(), (low - prev_close).abs()], axis=1
+    ).max(axis=1, skipna=False)
+
+
+@indicator("high_velocity", "high")
+def high_velocity(high):
+    return high.diff()
+
+
+@indicator("low_velocity", "low")
+def low_velocity(low):
+    return low.diff()
+
+
+# rolling statistics
+
+
+@indicator("close_mean", "close", windowed=True)
+def close_mean(close, window):
+    return close.rolling(window).mean()
+
+
+@indicator("close_std", "close", windowed=True)
+def close_std(close, window):
+    return close.rolling(window).std(ddof=0)
+
+
+@indicator("stdev", "close_std", windowed=True)
+def stdev(close_std, window):
+    # sample deviation, rescaled from the population one instead of recomputed
+    return close_std * sqrt(window / (window - 1))
+
+
+@indicator("volume_sum", "volume", windowed=True)
+def volume_sum(volume, window):
+    return volume.rolling(window).sum()
+
+
+# bollinger bands
+
+
+@indicator("bb_high", "close_mean", "close_std", windowed=True)
+def bb_high(close_mean, close_std, window):
+    return close_mean + 2 * close_std
+
+
+@indicator("bb_low", "close_mean", "close_std", windowed=True)
+def bb_low(close_mean, close_std, window):
+    return close_mean - 2 * close_std
+
+
+# volume weighted average price and its bands
+
+
+@indicator("vwap", "money_flow", "volume_sum", windowed=True)
+def vwap(money_flow, volume_sum, window):
+    return money_flow.rolling(window).sum() / volume_sum
+
+
+@indicator("vwap_vhigh", "vwap", "stdev", windowed=True)
+def vwap_vhigh(vwap, stdev, window):
+    return vwap + 2 * stdev
+
+
+@indicator("vwap_high", "vwap", "stdev", windowed=True)
+def vwap_high(vwap, stdev, window):
+    return vwap + 1 * stdev
+
+
+@indicator("vwap_low", "vwap", "stdev", windowed=True)
+def vwap_low(vwap, stdev, window):
+    return vwap - 1 * stdev
+
+
+@indicator("vwap_vlow", "vwap", "stdev", windowed=True)
+def vwap_vlow(vwap, stdev, window):
+    return vwap - 2 * stdev
+
+
+# average directional index, with wilder smoothing
+
+
+@indicator("plus_dm", "high", "low")
+def plus_dm(high, low):
+    up, down = high.diff(), -low.diff()
+    return up.where((up > down) & (up > 0), 0.0)
+
+
+@indicator("minus_dm", "high", "low")
+def minus_dm(high, low):
+    up, down = high.diff(), -low.diff()
+    return down.where((down > up) & (down > 0), 0.0)
+
+
+@indicator("atr", "true_range", windowed=True)
+def atr(true_range, window):
+    return wilder(true_range, window)
+
+
+@indicator("plus_di", "plus_dm", "atr", windowed=True)
+def plus_di(plus_dm, atr, window):
+    return 100 * wilder(plus_dm, window) / atr
+
+
+@indicator("minus_di", "minus_dm", "atr", windowed=True)
+def minus_di(minus_dm, atr, window):
+    return 100 * wilder(minus_dm, window) / atr
+
+
+@indicator("adx", "plus_di", "minus_di", windowed=True)
+def adx(plus_di, minus_di, window):
+    dx = 100 * (plus_di - minus_di).abs() / (plus_di + minus_di)
+    return wilder(dx, window)
+
+
+# money flow index
+
+
+@indicator("mfi", "typical_price", "money_flow", windowed=True)
+def mfi(typical_price, money_flow, window):
+    direction = np.sign(typical_price.diff())
+    positive = money_flow.where(direction > 0, 0.0).rolling(window).sum()
+    negative = money_flow.where(direction < 0, 0.0).rolling(window).sum()
+    return 100 - 100 / (1 + positive / negative)
+
+
+class IndicatorEngine:
+    def __init__(self, requests: dict):
+        """Plans the computation of the requested `{column: (name, window)}`."""
+        self.outputs = {
+            column: node_key(name, window) for column, (name, window) in requests.items()
+        }
+
+        self.plan = list()
+        planned = set()
+        for key in self.outputs.values():
+            self._resolve(key, planned, set())
+
+    def _resolve(self, key, planned, visiting):
+        name, window = key
+        if key in planned or name in SOURCES:
+            return
+        if key in visiting:
+            raise ValueError(f"Indicator {name!r} depends on itself")
+        visiting.add(key)
+
+        for dependency in REGISTRY[name].inputs:
+            self._resolve(node_key(dependency, window), planned, visiting)
+
+        self.plan.append(key)
+        planned.add(key)
+
+    def run(self, frame: pd.DataFrame) -> dict:
+        """Returns every requested column as a numpy array."""
+        return dict(zip(self.outputs, self.run_block(frame).T))
+
+    def run_block(self, frame: pd.DataFrame) -> np.ndarray:
+        """Returns the requested columns side by side, in the order they were
+        requested, so that the final row of all of them is a single slice."""
+        values = {(column, None): frame[column] for column in SOURCES}
+
+        for key in self.plan:
+            name, window = key
+            spec = REGISTRY[name]
+            inputs = [values[node_key(x, window)] for x in spec.inputs]
+            if spec.windowed:
+                values[key] = spec.compute(*inputs, window=window)
+            else:
+                values[key] = spec.compute(*inputs)
+
+        block = np.empty((len(frame), len(self.outputs)), order="F")
+        for i, key in enumerate(self.outputs.values()):
+            block[:, i] = values[key]
+        return block
@@ -0,0 +1,179 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+
+"""
+Append-only journal of what the trackers saw and decided on every tick.
+Records have a fixed size, so that a whole tick is packed into one buffered
+write and any date range can be read straight back into numpy. Files are synced
+periodically, and a new file is started once the current one grows too big,
+named after the close time of its first record.
+"""
+JOURNAL_MAGIC = b"FLIPJ001"
+
+JOURNAL_COLUMNS = (
+    "price",
+    "bb_high",
+    "bb_low",
+    "high_velocity",
+    "low_velocity",
+    "vwap",
+    "vwap_vhigh",
+    "vwap_high",
+    "vwap_low",
+    "vwap_vlow",
+)
+
+JOURNAL_RECORD = np.dtype(
+    [("close_time", "<i8"), ("symbol", "S16")]
+    + [(name, "<f8") for name in JOURNAL_COLUMNS]
+    + [("pre_signal", "i1"), ("signal", "i1")]
+)
+
+MAX_JOURNAL_BYTES = 64 * 1024 * 1024
+FSYNC_INTERVAL = 60
+
+
+def layout_groups(layouts: tuple, rows: tuple):
+    """Stacks the rows of every layout, trackers of one market share theirs."""
+    if all(x is layouts[0] for x in layouts):
+        yield layouts[0], slice(None), np.array(rows)
+        return
+
+    groups = dict()
+    for i, layout in enumerate(layouts):
+        groups.setdefault(id(layout), (layout, list()))[1].append(i)
+    for layout, index in groups.values():
+        yield layout, np.array(index), np.array([rows[i] for i in index])
+
+
+class TickJournal:
+    def __init__(
+        self,
+        folder="./journal",
+        max_bytes=MAX_JOURNAL_BYTES,
+        fsync_interval=FSYNC_INTERVAL,
+    ):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(folder, exist_ok=True)
+
+        self.rows = list()
+        self.file = None
+        self.size = 0
+        self.synced_at = time.monotonic()
+
+    def record(
+        self,
+        symbol: str,
+        close_time: int,
+        price: float,
+        columns: tuple,
+        row: np.ndarray,
+        pre_signal,
+        signal,
+    ):
+        """Keeps the final indicator `row`, laid out as `columns`, until the
+        next flush. The row is only unpacked then, for the whole tick at once."""
+        self.rows.append(
+            (close_time, symbol, price, pre_signal or 0, signal or 0, columns, row)
+        )
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        # filling field by field is far cheaper than converting row tuples
+        close_times, symbols, prices, pre_signals, signals, layouts, rows = zip(
+            *self.rows
+        )
+        self.rows.clear()
+
+        records = np.empty(len(rows), dtype=JOURNAL_RECORD)
+        records["close_time"] = close_times
+        records["symbol"] = symbols
+        records["price"] = prices
+        records["pre_signal"] = pre_signals
+        records["signal"] = signals
+
+        for layout, index, values in layout_groups(layouts, rows):
+            for name in JOURNAL_COLUMNS[1:]:
+                if name in layout:
+                    records[name][index] = values[:, layout.index(name)]
+                else:
+                    records[name][index] = np.nan
+
+        if self.file is None or self.size + records.nbytes > self.max_bytes:
+            self.rotate(int(records["close_time"].min()))
+
+        self.file.write(records.tobytes())
+        self.size += records.nbytes
+
+        if time.monotonic() - self.synced_at >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.synced_at = time.monotonic()
+
+    def rotate(self, close_time: int):
+        self.close()
+        path = os.path.join(self.folder, f"journal-{close_time}.bin")
+        self.file = open(path, "ab", buffering=1024 * 1024)
+        if not self.file.tell():
+            self.file.write(JOURNAL_MAGIC)
+        self.size = self.file.tell()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+def journal_files(folder: str) -> list:
+    files = list()
+    for name in os.listdir(folder):
+        if name.startswith("journal-") and name.endswith(".bin"):
+            files.append((int(name[len("journal-") : -len(".bin")]), name))
+    return sorted(files)
+
+
+def load_journal(
+    folder: str, start: datetime, end: datetime, symbols=None
+) -> np.ndarray:
+    """Reads every record closed within [start, end) as a structured array."""
+    since = int(start.timestamp() * 1000)
+    until = int(end.timestamp() * 1000)
+
+    files = journal_files(folder)
+    chunks = list()
+    for i, (first, name) in enumerate(files):
+        following = files[i + 1][0] if i + 1 < len(files) else None
+        if first >= until or (following is not None and following <= since):
+            continue
+
+        path = os.path.join(folder, name)
+        with open(path, "rb") as data_file:
+            if data_file.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+                raise ValueError(f"{path} is not a tick journal")
+            data = data_file.read()
+
+        # a crash may have left a partially written record behind
+        complete = len(data) - len(data) % JOURNAL_RECORD.itemsize
+        chunks.append(np.frombuffer(data[:complete], dtype=JOURNAL_RECORD))
+
+    if not chunks:
+        return np.empty(0, dtype=JOURNAL_RECORD)
+
+    records = np.concatenate(chunks)
+    mask = (records["close_time"] >= since) & (records["close_time"] < until)
+    if symbols is not None:
+        mask &= np.isin(records["symbol"], [x.encode() for x in symbols])
+    return records[mask]
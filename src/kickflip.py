@@ -3,44 +3,265 @@ import time
 import os
 import pickle
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from decimal import Decimal, getcontext
 
+import numpy as np
+import pandas as pd
+
 from trade_clients import make_binance_test_client, make_binance_client
 from binance.spot import Spot
 from binance.error import ClientError
 
-from pinkybrain import PinkyTracker
-from metaflip import FULL_CYCLE
+from indicators import IndicatorEngine
+from pinkybrain import PinkyTracker, replay_signals
+from metaflip import FULL_CYCLE, FIBONACCI, KLinePoint, MarketSignal
+
+KLINES_PAGE = 1000
+YEARLY_CYCLE = 365 * 24
 
 
-def smart_read(client: Spot, symbol: str):
+def smart_read(client: Spot, symbol: str, limit=FULL_CYCLE):
     data = list()
     this_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
-    start_at = this_hour - timedelta(hours=FULL_CYCLE)
+    start_at = this_hour - timedelta(hours=limit)
     since = int(start_at.timestamp()) * 1000
     enough = int(this_hour.timestamp()) * 1000
 
+    os.makedirs(f"./{symbol}", exist_ok=True)
     cache_file = f"./{symbol}/klines.dat"
     if os.path.isfile(cache_file):
         with open(cache_file, "rb") as data_file:
             data += pickle.load(data_file)
         print(f"Read {len(data)} records from {cache_file}")
+    cached = len(data)
+
+    if data and data[0][0] > since + 3600 * 1000:
+        print(f"Cached records do not reach back {limit} hours, refreshing.")
+        data = list()
 
     if data and data[-1][6] > since:
         since = data[-1][6]
 
     if since < enough:
-        missing_chunk = client.klines(symbol, "1h", startTime=since, limit=FULL_CYCLE)
-        data += missing_chunk
-        print(f"Read {len(missing_chunk)} records from client.")
+        while since < enough:
+            missing_chunk = client.klines(
+                symbol, "1h", startTime=since, limit=min(limit, KLINES_PAGE)
+            )
+            if not missing_chunk:
+                break
+            data += missing_chunk
+            since = missing_chunk[-1][6]
+            print(f"Read {len(missing_chunk)} records from client.")
 
         with open(cache_file, "wb") as data_file:
-            useful_data = data[-FULL_CYCLE:-1]
+            # never shrink a longer history cached by a previous evaluation
+            useful_data = data[-max(limit, cached + 1) : -1]
             pickle.dump(useful_data, data_file, protocol=pickle.HIGHEST_PROTOCOL)
             print(f"Cached {len(useful_data)} to {cache_file}")
 
-    return data[-FULL_CYCLE:]
+    return data[-limit:]
+
+
+"""
+Robustness evaluation.
+Candles are kept as plain float arrays, so that thousands of resampled paths
+can be replayed without going through Decimal candlesticks. Resampled paths
+are rebuilt from every candle's open, high, low and close relative to the
+previous close, drawn in blocks to preserve short term autocorrelation.
+"""
+EVALUATED_INDICATORS = ("bb_high", "bb_low", "high_velocity", "low_velocity")
+
+history = dict()
+
+
+def candle_arrays(kline_data) -> dict:
+    klines = np.array([KLinePoint(*x)[1:6] for x in kline_data], dtype=float)
+    return dict(zip(("open", "high", "low", "close", "volume"), klines.T))
+
+
+def resample_path(candles: dict, block: int, rng: np.random.Generator) -> dict:
+    close = candles["close"]
+    size = close.size - 1
+
+    starts = rng.integers(1, size - block + 2, size=-(-size // block))
+    index = (starts[:, None] + np.arange(block)).ravel()[:size]
+
+    previous = close[index - 1]
+    growth = np.cumprod(close[index] / previous)
+    base = close[0] * np.concatenate(([1.0], growth[:-1]))
+
+    path = {
+        name: np.concatenate(
+            ([candles[name][0]], base * candles[name][index] / previous)
+        )
+        for name in ("open", "high", "low")
+    }
+    path["close"] = close[0] * np.concatenate(([1.0], growth))
+    path["volume"] = np.concatenate(([candles["volume"][0]], candles["volume"][index]))
+    return path
+
+
+def simulate(
+    candles: dict, wix: int, commission: float, budget: float = 1.0, start: int = 0
+) -> dict:
+    """Trades from `start` onwards, earlier candles only warm up the indicators."""
+    window = FIBONACCI[wix]
+    engine = IndicatorEngine({name: (name, window) for name in EVALUATED_INDICATORS})
+    values = engine.run(pd.DataFrame(candles))
+
+    # plain floats replay much faster than numpy scalars
+    close = candles["close"].tolist()
+    _, signals = replay_signals(
+        close,
+        values["bb_high"].tolist(),
+        values["bb_low"].tolist(),
+        values["high_velocity"].tolist(),
+        values["low_velocity"].tolist(),
+    )
+
+    # long only, all-in on every buy
+    cash, amount, entry = budget, 0.0, 0.0
+    wins, trades = 0, 0
+    equity = list()
+    for price, signal in zip(close[start:], signals[start:]):
+        if signal == MarketSignal.BUY and not amount:
+            amount, entry, cash = cash * (1 - commission) / price, cash, 0.0
+        elif signal == MarketSignal.SELL and amount:
+            cash, amount = amount * price * (1 - commission), 0.0
+            wins += cash > entry
+            trades += 1
+        equity.append(cash + amount * price)
+
+    equity = np.array(equity)
+    peak = np.maximum.accumulate(np.maximum(equity, budget))
+
+    return dict(
+        pnl=float(equity[-1] - budget),
+        drawdown=float(np.max(1 - equity / peak)),
+        hit_rate=wins / trades if trades else np.nan,
+        trades=trades,
+    )
+
+
+def share_history(candles: dict):
+    history.update(candles)
+
+
+def monte_carlo_path(args) -> dict:
+    symbol, wix, commission, budget, block, seed = args
+    path = resample_path(history[symbol], block, np.random.default_rng(seed))
+    return simulate(path, wix, commission, budget)
+
+
+def walk_forward_window(args) -> dict:
+    symbol, wixes, commission, budget, train, test = args
+    candles = history[symbol]
+    warm_up = FIBONACCI[max(wixes)]
+
+    in_sample = {name: values[train] for name, values in candles.items()}
+    best_wix = max(wixes, key=lambda x: simulate(in_sample, x, commission)["pnl"])
+
+    # keep enough candles ahead of the test slice to warm up the indicators
+    span = slice(max(test.start - warm_up, 0), test.stop)
+    out_of_sample = {name: values[span] for name, values in candles.items()}
+    result = simulate(
+        out_of_sample, best_wix, commission, budget, start=test.start - span.start
+    )
+    result["wix"] = best_wix
+    return result
+
+
+def summarize(symbol: str, mode: str, results: list):
+    print(f"{symbol} {mode}: {len(results)} runs")
+    for metric in ("pnl", "drawdown", "hit_rate", "trades"):
+        values = np.array([x[metric] for x in results], dtype=float)
+        values = values[~np.isnan(values)]
+        if not values.size:
+            print(f"{metric:>10}  n/a")
+            continue
+        p5, p50, p95 = np.percentile(values, [5, 50, 95])
+        print(
+            f"{metric:>10}  mean {values.mean():9.4f}  p5 {p5:9.4f}"
+            f"  p50 {p50:9.4f}  p95 {p95:9.4f}"
+        )
+
+
+def evaluate(client: Spot, symbols: list, options) -> int:
+    # walk-forward picks among the neighbouring windows as well
+    if not 1 <= options.wix <= len(FIBONACCI) - 2:
+        print(f"x: --wix must be between 1 and {len(FIBONACCI) - 2}")
+        return -1
+    for name in ("block", "paths", "train", "test"):
+        if getattr(options, name) < 1:
+            print(f"x: --{name} must be at least 1")
+            return -1
+
+    try:
+        account_data = client.account()
+    except ClientError as error:
+        print("Client error:", error.error_message)
+        return -1
+    commission = float(account_data["makerCommission"] or 10) / 10000
+    budget = float(options.budget)
+
+    candles = dict()
+    for symbol in symbols:
+        try:
+            candles[symbol] = candle_arrays(smart_read(client, symbol, options.hours))
+        except ClientError as error:
+            print("x: Cannot read klines:", error.error_message)
+            return -1
+
+        size = candles[symbol]["close"].size
+        if options.mode == "monte-carlo" and options.block >= size:
+            print(f"x: Only {size} candles of {symbol}, too few for such blocks")
+            return -1
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=options.workers, initializer=share_history, initargs=(candles,)
+    ) as pool:
+        for symbol in symbols:
+            if options.mode == "monte-carlo":
+                tasks = [
+                    (
+                        symbol,
+                        options.wix,
+                        commission,
+                        budget,
+                        options.block,
+                        options.seed + i,
+                    )
+                    for i in range(options.paths)
+                ]
+                runs = pool.map(monte_carlo_path, tasks, chunksize=32)
+                summarize(symbol, options.mode, list(runs))
+            else:
+                size = candles[symbol]["close"].size
+                wixes = range(options.wix - 1, options.wix + 2)
+                tasks = [
+                    (
+                        symbol,
+                        wixes,
+                        commission,
+                        budget,
+                        slice(start, start + options.train),
+                        slice(
+                            start + options.train, start + options.train + options.test
+                        ),
+                    )
+                    for start in range(
+                        0, size - options.train - options.test + 1, options.test
+                    )
+                ]
+                runs = list(pool.map(walk_forward_window, tasks))
+                summarize(symbol, options.mode, runs)
+                print("  chosen wix:", [x["wix"] for x in runs])
+
+    print(f"Evaluated in {time.perf_counter() - started:.1f} seconds.")
+    return 0
 
 
 def run(client: Spot, symbol: str, budget: Decimal):
@@ -82,7 +303,6 @@ def run(client: Spot, symbol: str, budget: Decimal):
         wallet_value += value
     print(f"               (value) {wallet_value:12.2f} EUR")
 
-    os.makedirs(f"./{symbol}", exist_ok=True)
     try:
         data = smart_read(client, symbol)
     except ClientError as error:
@@ -90,8 +310,9 @@ def run(client: Spot, symbol: str, budget: Decimal):
         return -1
 
     pair = (symbol_data["baseAsset"], symbol_data["quoteAsset"])
-    flippy = PinkyTracker(pair, budget, commission, wix=5)
+    flippy = PinkyTracker(pair, wix=5)
     flippy.feed(data)
+    flippy.run_indicators()
     flippy.backtest()
 
     # flippy.draw_weekly_plus()
@@ -100,9 +321,22 @@ def run(client: Spot, symbol: str, budget: Decimal):
 if __name__ == "__main__":
 
     args = ArgumentParser(description="Trading on the flip side")
-    args.add_argument("--pair", required=True)
+    args.add_argument("--pair", required=True, nargs="+")
     args.add_argument("--budget", type=Decimal, required=True)
     args.add_argument("--go-live", action="store_const", const=True, default=False)
+    args.add_argument(
+        "--mode",
+        choices=("backtest", "walk-forward", "monte-carlo"),
+        default="backtest",
+    )
+    args.add_argument("--hours", type=int, default=YEARLY_CYCLE)
+    args.add_argument("--wix", type=int, default=5)
+    args.add_argument("--paths", type=int, default=1000)
+    args.add_argument("--block", type=int, default=24)
+    args.add_argument("--train", type=int, default=FULL_CYCLE)
+    args.add_argument("--test", type=int, default=FULL_CYCLE // 4)
+    args.add_argument("--workers", type=int, default=None)
+    args.add_argument("--seed", type=int, default=0)
 
     actual = args.parse_args()
 
@@ -113,5 +347,10 @@ if __name__ == "__main__":
         print("- using test connector")
         client = make_binance_test_client()
 
-    ret_code = run(client, actual.pair, actual.budget)
+    if actual.mode == "backtest":
+        ret_code = 0
+        for pair in actual.pair:
+            ret_code = run(client, pair, actual.budget) or ret_code
+    else:
+        ret_code = evaluate(client, actual.pair, actual)
     exit(ret_code)
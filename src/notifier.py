@@ -33,3 +33,26 @@ class TelegramNotifier:
             )
 
         return data
+
+    def send_photo(self, path, caption=""):
+        url = "https://api.telegram.org/bot{token}/sendPhoto".format(
+            token=self.token,
+        )
+        with open(path, "rb") as photo:
+            response = requests.post(
+                url,
+                data=dict(chat_id=self.chat_id, caption=caption),
+                files=dict(photo=photo),
+                timeout=30,
+            )
+
+        data = response.json()
+        if not data["ok"]:
+            print(
+                "Notification error {code}: {description}".format(
+                    code=data["error_code"],
+                    description=data["description"],
+                )
+            )
+
+        return data
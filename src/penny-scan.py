@@ -2,9 +2,12 @@
 
 import os
 import pickle
+import queue
 import time
 import schedule
+import signal
 import sys
+import threading
 from argparse import ArgumentParser
 from datetime import datetime, timedelta
 from decimal import Decimal, getcontext
@@ -12,14 +15,17 @@ from statistics import mean
 
 from metaflip import WEEKLY_CYCLE, FAST_CYCLE, MarketSignal
 from trade_clients import (
-    make_binance_client,
-    make_binance_test_client,
-    make_telegram_client,
+    make_accounts,
     Spot,
     ClientError,
     TelegramNotifier,
 )
 from pinkybrain import PinkyTracker
+from chartist import ChartWorker, CHART_INDICATORS
+from profiler import TickProfiler
+from journal import TickJournal
+from aggtrades import AggTradeStream, STREAM_URL, TEST_STREAM_URL
+from screener import MarketScreener, SCREEN_INTERVAL
 
 
 def set_decimal_precison_context(symbol_data):
@@ -28,17 +34,33 @@ def set_decimal_precison_context(symbol_data):
     )
 
 
-class PennyHunter:
+class MarketPipeline:
+    """Market data and indicators, shared by all accounts watching a symbol."""
+
     PREFFERED_QUOTE_ASSETS = ("EUR", "USD", "USDT", "BUSD")
 
-    def __init__(self, client: Spot, notifier: TelegramNotifier):
+    def __init__(
+        self,
+        client: Spot,
+        profiler: TickProfiler,
+        journal=None,
+        stream=None,
+        charted=False,
+    ):
         self.client = client
-        self.notifier = notifier
+        self.profiler = profiler
+        self.journal = journal
+        self.stream = stream
+
+        self.indicators = PinkyTracker.INDICATORS
+        if charted or journal is not None:
+            self.indicators += PinkyTracker.VWAP_BANDS
 
         self.sniffers = dict()
-        self.last_signal = dict()
-        self.commited = dict()
+        self.holders = dict()
         self.all_symbols = dict()
+        self.tradable = set()
+        self.tick_sizes = dict()
 
         exchage_data = self.client.exchange_info()
         serverTimestamp = int(exchage_data["serverTime"]) // 1000
@@ -58,6 +80,13 @@ class PennyHunter:
                 symbol_data["quoteAsset"],
             )
             quote_symbols.add(symbol_data["quoteAsset"])
+            for price_filter in symbol_data.get("filters", list()):
+                if price_filter["filterType"] == "PRICE_FILTER":
+                    tick_size = float(price_filter["tickSize"])
+                    # a zero tick size means the price filter is disabled
+                    if tick_size > 0:
+                        self.tick_sizes[symbol_data["symbol"]] = tick_size
+        self.update_tradable(exchage_data)
 
         getcontext().prec = precision
         print(". set decimal precision to", precision, "digits")
@@ -67,10 +96,141 @@ class PennyHunter:
         )
         print(". expressing values in", self.value_asset)
 
+    def update_tradable(self, exchage_data: dict = None):
+        """Keeps track of the pairs open for trading, halted ones drop out."""
+        exchage_data = exchage_data or self.client.exchange_info()
+        self.tradable = {
+            x["symbol"]
+            for x in exchage_data["symbols"]
+            if x.get("status", "TRADING") == "TRADING"
+        }
+
+    def subscribe(self, symbol: str, holder):
+        holders = self.holders.setdefault(symbol, set())
+        holders.add(holder)
+        if symbol not in self.sniffers:
+            self.sniffers[symbol] = PinkyTracker(
+                self.all_symbols[symbol],
+                indicators=self.indicators,
+                journaled=self.journal is not None,
+            )
+            if self.stream:
+                self.stream.subscribe(symbol, self.tick_sizes.get(symbol))
+
+    def unsubscribe(self, symbol: str, holder):
+        holders = self.holders.get(symbol, set())
+        holders.discard(holder)
+        if not holders:
+            self.holders.pop(symbol, None)
+            self.sniffers.pop(symbol, None)
+            if self.stream:
+                self.stream.unsubscribe(symbol)
+
+    def warm_up(self):
+        for symbol, dog in self.sniffers.items():
+            data = self.live_read(symbol)
+            dog.feed(data, limit=FAST_CYCLE)
+            dog.run_indicators()
+
+    def tick(self):
+        signals = dict()
+        for symbol, dog in self.sniffers.items():
+            with self.profiler.stage(symbol, "fetch"):
+                data = self.live_read(symbol, since=dog.pop_close_time())
+            with self.profiler.stage(symbol, "feed"):
+                dog.feed(data)
+            with self.profiler.stage(symbol, "indicators"):
+                dog.run_indicators()
+            with self.profiler.stage(symbol, "triggers"):
+                signals[symbol] = dog.compute_triggers()
+            if self.journal:
+                price, close_time = dog.last_close
+                self.journal.record(
+                    symbol,
+                    close_time,
+                    price,
+                    dog.columns,
+                    dog.latest,
+                    dog.pre_signal,
+                    signals[symbol],
+                )
+
+        if self.journal:
+            with self.profiler.stage("all", "journal"):
+                self.journal.flush()
+        return signals
+
+    def cached_read(self, symbol: str, limit=WEEKLY_CYCLE):
+        this_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        start_at = this_hour - timedelta(hours=limit)
+        since = int(start_at.timestamp()) * 1000
+        enough = int(this_hour.timestamp()) * 1000
+
+        cache_file = f"./{symbol}/klines.dat"
+
+        data = list()
+        if os.path.isfile(cache_file):
+            with open(cache_file, "rb") as data_file:
+                data += pickle.load(data_file)
+            print(f"Read {len(data)} records from {cache_file}")
+
+        if data and data[-1][6] > since:
+            since = data[-1][6]
+
+        if since < enough:
+            missing_chunk = self.client.klines(
+                symbol, "1h", startTime=since, limit=limit
+            )
+            data += missing_chunk
+            print(f"Read {len(missing_chunk)} {symbol} records from client.")
+
+            with open(cache_file, "wb") as data_file:
+                useful_data = data[-limit:-1]
+                pickle.dump(useful_data, data_file, protocol=pickle.HIGHEST_PROTOCOL)
+                print(f"Cached {len(useful_data)} to {cache_file}")
+
+        return data[-limit:]
+
+    def point_of_control(self, symbol: str):
+        return self.stream.point_of_control(symbol) if self.stream else None
+
+    def live_read(self, symbol: str, limit=FAST_CYCLE, since=None):
+        if self.stream and since is not None:
+            data = self.stream.klines(symbol, since, limit)
+            if data is not None:
+                return data
+        return self.client.klines(symbol, "1m", limit=limit, startTime=since)
+
+
+class PennyHunter:
+    """Wallet, trade ledger and notifications of a single account."""
+
+    def __init__(
+        self,
+        client: Spot,
+        notifier: TelegramNotifier,
+        market: MarketPipeline,
+        name: str = "",
+    ):
+        self.client = client
+        self.notifier = notifier
+        self.market = market
+        self.name = name
+
+        self.symbols = set()
+        self.alerts = set()
+        self.last_signal = dict()
+        self.commited = dict()
+        self.wallet = dict()
+
         account_data = self.client.account()
         assert account_data["makerCommission"] == account_data["takerCommission"]
         self.commission = Decimal(account_data["makerCommission"] or 10) / 10000
 
+    @property
+    def value_asset(self):
+        return self.market.value_asset
+
     def update_balance(self):
         account_data = self.client.account()
         balances = list(
@@ -83,19 +243,22 @@ class PennyHunter:
         active_symbols = {
             x["asset"] + self.value_asset
             for x in balances
-            if (x["asset"] + self.value_asset) in self.all_symbols
+            if (x["asset"] + self.value_asset) in self.market.all_symbols
         }
 
         self.estimate_wallet_value(balances, active_symbols)
 
         # update sniffers
-        lost_dogs = self.sniffers.keys() - active_symbols
-        found_dogs = active_symbols - self.sniffers.keys()
+        lost_dogs = self.symbols - active_symbols
+        found_dogs = active_symbols - self.symbols
 
-        list(map(self.sniffers.pop, lost_dogs))
-        self.sniffers.update(
-            {name: PinkyTracker(self.all_symbols[name]) for name in found_dogs}
-        )
+        for symbol in lost_dogs:
+            self.market.unsubscribe(symbol, self.name)
+            self.commited.pop(symbol, None)
+            self.last_signal.pop(symbol, None)
+        for symbol in found_dogs:
+            self.market.subscribe(symbol, self.name)
+        self.symbols = active_symbols
 
         if lost_dogs:
             self.notifier.say(f"Lost: `{lost_dogs}`")
@@ -114,7 +277,7 @@ class PennyHunter:
             self.wallet[name] = value
 
     def update_trades(self):
-        for symbol in self.sniffers:
+        for symbol in self.symbols:
             my_trades = self.client.my_trades(symbol)
 
             bougth = Decimal(0)
@@ -127,162 +290,279 @@ class PennyHunter:
             self.commited[symbol] = bougth, mean(price) if price else Decimal(0)
 
     def pre_tick(self):
-        self.update_balance()
-        self.update_trades()
-
-    def tick(self):
-        print(".", end="", flush=True)
-
-        for symbol, dog in self.sniffers.items():
-            data = self.live_read(symbol, since=dog.pop_close_time())
-            dog.feed(data)
-            dog.run_indicators()
-            signal = dog.compute_triggers()
-
-            bougth, price = self.commited[symbol]
-            profit = (Decimal(dog.price) - price) * bougth * (1 - self.commission)
-
-            if bougth > Decimal(0) and signal == MarketSignal.SELL:
-                print("/")
-                message = (
-                    "{base} may be {status} at {price:.2f} EUR. We should {action}.\n"
-                    "Estimated profit {profit:.2f} EUR\n"
-                    "_open_ [spot trading](https://www.binance.com/en/trade/{base}_{quote}?type=spot)"
-                ).format(
-                    base=dog.base_symbol,
-                    quote=dog.quote_symbol,
-                    status="overbought",
-                    price=dog.price,
-                    profit=profit,
-                    action=signal.name,
-                )
-                self.notifier.say(message)
-            elif self.wallet.get("EUR", 0) > 20 and signal == MarketSignal.BUY:
-                print("/")
-                message = (
-                    "{base} may be {status} at {price:.2f} EUR. We should {action}.\n"
-                    "Available: {fiat:.2f} EUR\n"
-                    "_open_ [spot trading](https://www.binance.com/en/trade/{base}_{quote}?type=spot)"
-                ).format(
-                    base=dog.base_symbol,
-                    quote=dog.quote_symbol,
-                    status="oversold",
-                    fiat=self.wallet.get("EUR", 0),
-                    price=dog.price,
-                    action=signal.name,
-                )
-                self.notifier.say(message)
+        with self.market.profiler.stage(self.name or "account", "balance"):
+            self.update_balance()
+        with self.market.profiler.stage(self.name or "account", "trades"):
+            self.update_trades()
 
-            self.last_signal[symbol] = signal
+    def react(self, signals: dict, watched=()):
+        self.alerts = set()
+        for symbol in self.symbols | set(watched):
+            signal = signals.get(symbol)
+            if signal is None:
+                continue
+
+            with self.market.profiler.stage(symbol, "notify"):
+                self.notify(symbol, signal)
+
+    def notify(self, symbol: str, signal: MarketSignal):
+        dog = self.market.sniffers[symbol]
+        bougth, price = self.commited.get(symbol, (Decimal(0), Decimal(0)))
+        profit = (Decimal(dog.price) - price) * bougth * (1 - self.commission)
+
+        volume = ""
+        point_of_control = self.market.point_of_control(symbol)
+        if point_of_control is not None:
+            volume = f"Most traded lately at {point_of_control:.2f} EUR\n"
+
+        if bougth > Decimal(0) and signal == MarketSignal.SELL:
+            print("/")
+            message = (
+                "{base} may be {status} at {price:.2f} EUR. We should {action}.\n"
+                "Estimated profit {profit:.2f} EUR\n"
+                "{volume}"
+                "_open_ [spot trading](https://www.binance.com/en/trade/{base}_{quote}?type=spot)"
+            ).format(
+                base=dog.base_symbol,
+                quote=dog.quote_symbol,
+                status="overbought",
+                price=dog.price,
+                profit=profit,
+                volume=volume,
+                action=signal.name,
+            )
+            self.notifier.say(message)
+            self.alerts.add(symbol)
+        elif self.wallet.get("EUR", 0) > 20 and signal == MarketSignal.BUY:
+            print("/")
+            message = (
+                "{base} may be {status} at {price:.2f} EUR. We should {action}.\n"
+                "Available: {fiat:.2f} EUR\n"
+                "{volume}"
+                "_open_ [spot trading](https://www.binance.com/en/trade/{base}_{quote}?type=spot)"
+            ).format(
+                base=dog.base_symbol,
+                quote=dog.quote_symbol,
+                status="oversold",
+                fiat=self.wallet.get("EUR", 0),
+                volume=volume,
+                price=dog.price,
+                action=signal.name,
+            )
+            self.notifier.say(message)
+            self.alerts.add(symbol)
+
+        self.last_signal[symbol] = signal
+
+
+class PennyPack:
+    """Runs several accounts on top of a single market pipeline."""
+
+    def __init__(
+        self,
+        accounts: list,
+        charts: bool = False,
+        journal: bool = False,
+        stream: AggTradeStream = None,
+        screened: int = 0,
+    ):
+        _, market_client, _ = accounts[0]
+        self.profiler = TickProfiler()
+        self.stream = stream
+        self.market = MarketPipeline(
+            market_client,
+            self.profiler,
+            TickJournal() if journal else None,
+            stream,
+            charted=charts,
+        )
+        self.hunters = [
+            PennyHunter(client, notifier, self.market, name=name)
+            for name, client, notifier in accounts
+        ]
 
-    def cached_read(self, symbol: str, limit=WEEKLY_CYCLE):
-        this_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
-        start_at = this_hour - timedelta(hours=limit)
-        since = int(start_at.timestamp()) * 1000
-        enough = int(this_hour.timestamp()) * 1000
+        self.charts = ChartWorker() if charts else None
+        self.pending_charts = dict()
+        self.uploads = queue.Queue()
 
-        cache_file = f"./{symbol}/klines.dat"
+        self.screener = MarketScreener(self.market, size=screened) if screened else None
 
-        data = list()
-        if os.path.isfile(cache_file):
-            with open(cache_file, "rb") as data_file:
-                data += pickle.load(data_file)
-            print(f"Read {len(data)} records from {cache_file}")
-
-        if data and data[-1][6] > since:
-            since = data[-1][6]
-
-        if since < enough:
-            missing_chunk = client.klines(symbol, "1h", startTime=since, limit=limit)
-            data += missing_chunk
-            print(f"Read {len(missing_chunk)} {symbol} records from client.")
+    def broadcast(self, message: str):
+        for notifier in self.chats(self.hunters).values():
+            notifier.say(message)
 
-            with open(cache_file, "wb") as data_file:
-                useful_data = data[-limit:-1]
-                pickle.dump(useful_data, data_file, protocol=pickle.HIGHEST_PROTOCOL)
-                print(f"Cached {len(useful_data)} to {cache_file}")
+    @staticmethod
+    def chats(hunters) -> dict:
+        """Maps every distinct chat to one notifier, so that hunters sharing a
+        chat are only notified once."""
+        return {(x.notifier.token, x.notifier.chat_id): x.notifier for x in hunters}
 
-        return data[-limit:]
+    def pre_tick(self):
+        self.profiler.begin_cycle()
+        for hunter in self.hunters:
+            self.spin_exec(hunter.pre_tick, say=hunter.notifier.say)
 
-    def live_read(self, symbol: str, limit=FAST_CYCLE, since=None):
-        return client.klines(symbol, "1m", limit=limit, startTime=since)
+    def tick(self):
+        print(".", end="", flush=True)
 
-    def spin_exec(self, method: callable):
         try:
-            method()
+            signals = self.market.tick()
+
+            # screened pairs are announced once per chat, by the first account
+            # routed there that would act on them
+            announced = dict()
+            for hunter in self.hunters:
+                chat = hunter.notifier.token, hunter.notifier.chat_id
+                seen = announced.setdefault(chat, set())
+                watched = set(self.watched) - seen
+                self.spin_exec(hunter.react, signals, watched, say=hunter.notifier.say)
+                seen.update(hunter.alerts)
+
+            if self.charts:
+                with self.profiler.stage("all", "charts"):
+                    self.request_charts()
+        finally:
+            self.profiler.end_cycle()
+
+    @property
+    def watched(self):
+        return self.screener.symbols if self.screener else ()
+
+    def request_charts(self):
+        alerted = set().union(*(x.alerts for x in self.hunters))
+        for symbol in alerted:
+            payload = self.market.sniffers[symbol].chart_payload(CHART_INDICATORS)
+            key = symbol, payload["close_time"]
+            if key not in self.pending_charts:
+                self.charts.request(payload)
+                self.pending_charts[key] = dict()
+
+            hunters = [x for x in self.hunters if symbol in x.alerts]
+            self.pending_charts[key].update(self.chats(hunters))
+
+    def deliver_charts(self):
+        for symbol, close_time, path, error in self.charts.collect():
+            notifiers = self.pending_charts.pop((symbol, close_time), dict())
+            if error:
+                print(f"Chart for {symbol} failed, {error}")
+                continue
+            for notifier in notifiers.values():
+                self.uploads.put((notifier, path, symbol))
+
+        if not self.charts.alive:
+            print("Chart worker stopped, charts disabled.")
+            self.charts = None
+            self.pending_charts.clear()
+
+    def upload_charts(self):
+        # telegram uploads are slow, so they never run on the tick loop
+        while True:
+            notifier, path, symbol = self.uploads.get()
+            try:
+                notifier.send_photo(path, caption=symbol)
+            except Exception as error:
+                print(f"Chart for {symbol} not sent, {error}")
+
+    def spin_exec(self, method: callable, *args, say: callable = None):
+        say = say or self.broadcast
+        try:
+            method(*args)
         except ClientError as exc:
             msg = (
                 "`ClientError({code})` occured durring `{method}()`:\n{message}".format(
-                    code=exc.status_code, method="startup", message=exc.error_message
+                    code=exc.status_code,
+                    method=method.__name__,
+                    message=exc.error_message,
                 )
             )
             print(msg)
-            self.notifier.say(msg)
+            say(msg)
         except Exception as err:
             ex_type, ex_value, _ = sys.exc_info()
             msg = "`{type}` occured durring `{method}()`:\n{message}.".format(
                 type=ex_type.__name__, method=method.__name__, message=ex_value
             )
             print(msg)
-            self.notifier.say(msg)
+            say(msg)
 
     def start_spinning(self):
-        print("Starting penny-tracker service")
-
-        try:
-            self.update_balance()
-            self.update_trades()
+        print("Starting penny-tracker service for", len(self.hunters), "account(s)")
+        self.profiler.listen()
+        if self.stream:
+            self.spin_exec(self.stream.connect)
 
-            for symbol, dog in self.sniffers.items():
-                data = self.live_read(symbol)
-                dog.feed(data, limit=FAST_CYCLE)
-                dog.run_indicators()
+        self.spin_exec(self.pre_tick)
+        if self.screener:
+            self.spin_exec(self.screener.screen)
+        self.spin_exec(self.market.warm_up)
 
-        except ClientError as exc:
-            msg = (
-                "`ClientError({code})` occured durring `{method}()`:\n{message}".format(
-                    code=exc.status_code,
-                    method="start_spinning",
-                    message=exc.error_message,
-                )
+        schedule.every().minute.at(":07").do(lambda: self.spin_exec(self.pre_tick))
+        schedule.every().minute.at(":13").do(lambda: self.spin_exec(self.tick))
+        if self.stream:
+            schedule.every(10).seconds.do(lambda: self.spin_exec(self.stream.check))
+        if self.screener:
+            schedule.every(SCREEN_INTERVAL).seconds.do(
+                lambda: self.spin_exec(self.screener.screen)
             )
-            print(msg)
-            self.notifier.say(msg)
-
-        except Exception as err:
-            ex_type, ex_value, _ = sys.exc_info()
-            msg = "`{type}` occured durring `{method}()`:\n{message}.".format(
-                type=ex_type.__name__, method="start_spinning", message=ex_value
+        if self.charts:
+            threading.Thread(target=self.upload_charts, daemon=True).start()
+            schedule.every(3).seconds.do(
+                lambda: self.charts and self.spin_exec(self.deliver_charts)
             )
-            print(msg)
-            self.notifier.say(msg)
 
-        schedule.every().minute.at(":07").do(lambda: self.spin_exec(self.pre_tick))
-        schedule.every().minute.at(":13").do(lambda: self.spin_exec(self.tick))
+        # docker stops the container with SIGTERM, let it unwind like ctrl-c
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            while True:
+                schedule.run_pending()
+                time.sleep(0.1)
+        finally:
+            self.shutdown()
 
-        while True:
-            schedule.run_pending()
-            time.sleep(0.1)
+    def shutdown(self):
+        if self.market.journal:
+            self.market.journal.close()
+        if self.stream:
+            self.stream.stop()
+        if self.charts:
+            self.charts.stop()
 
 
 if __name__ == "__main__":
 
     args = ArgumentParser(description="Trading on the flip side")
     args.add_argument("--go-live", action="store_const", const=True, default=False)
+    args.add_argument("--charts", action="store_const", const=True, default=False)
+    args.add_argument("--journal", action="store_const", const=True, default=False)
+    args.add_argument("--agg-trades", action="store_const", const=True, default=False)
+    args.add_argument("--record-trades", default=None)
+    args.add_argument("--screen", type=int, default=0, metavar="PAIRS")
 
     actual = args.parse_args()
     print("--- action! ---")
 
     if actual.go_live:
         print(". using live connector")
-        client = make_binance_client()
     else:
         print(". using test connector")
-        client = make_binance_test_client()
-
-    notifier = make_telegram_client()
+    accounts = make_accounts(actual.go_live)
+    print(". loaded", len(accounts), "account(s)")
+
+    stream = None
+    if actual.agg_trades:
+        print(". building candles from aggregated trades")
+        stream = AggTradeStream(
+            stream_url=STREAM_URL if actual.go_live else TEST_STREAM_URL,
+            recording=actual.record_trades,
+        )
 
-    penny = PennyHunter(client, notifier)
-    penny.start_spinning()
+    pack = PennyPack(
+        accounts,
+        charts=actual.charts,
+        journal=actual.journal,
+        stream=stream,
+        screened=actual.screen,
+    )
+    pack.start_spinning()
 
     print("--- the end ---")
@@ -1,9 +1,7 @@
 import os
 import pandas as pd
-from ta.volatility import BollingerBands
-from ta.trend import ADXIndicator
-from ta.volume import money_flow_index, volume_weighted_average_price
 
+from indicators import IndicatorEngine
 from metaflip import (
     CandleStick,
     MarketSignal,
@@ -11,14 +9,32 @@ from metaflip import (
     FIBONACCI,
 )
 
-# import mplfinance as mpf
-# from matplotlib import pyplot as plt
-
 
 class PinkyTracker:
-    def __init__(self, trading_pair, wix=6):
+    # what compute_triggers reads
+    INDICATORS = (
+        "high_velocity",
+        "low_velocity",
+        "bb_high",
+        "bb_low",
+    )
+    # only worth computing when something charts or journals them
+    VWAP_BANDS = (
+        "vwap",
+        "vwap_vhigh",
+        "vwap_high",
+        "vwap_low",
+        "vwap_vlow",
+    )
+
+    def __init__(self, trading_pair, wix=6, indicators=INDICATORS, journaled=False):
         self.base_symbol, self.quote_symbol = trading_pair
         self.wix = wix
+        self.journaled = journaled
+        self.columns = tuple(indicators)
+        self.indicators = IndicatorEngine(
+            {name: (name, self.window) for name in self.columns}
+        )
 
         self.data = pd.DataFrame(
             columns=[
@@ -33,6 +49,8 @@ class PinkyTracker:
         )
 
         self.pre_signal = None
+        self.latest = None
+        self.last_close = None
 
         # prepare for cached reads
         # symbol = "".join(trading_pair)
@@ -80,6 +98,7 @@ class PinkyTracker:
             print(f"Provided feed was truncated to last {len(kline_data)}.")
 
         klines = [CandleStick(x) for x in kline_data]
+        self.last_close = float(kline_data[-1][4]), int(kline_data[-1][6])
         new_df = pd.DataFrame(klines)
         new_df.index = pd.DatetimeIndex(new_df["open_time"])
 
@@ -96,28 +115,15 @@ class PinkyTracker:
             }
         )
 
-        # self.data["velocity"] = self.data["close"].diff()
-        self.data["high_velocity"] = self.data["high"].diff()
-        self.data["low_velocity"] = self.data["low"].diff()
-
-        bb = BollingerBands(close=df["close"], window=self.window)
-        self.data["bb_high"] = bb.bollinger_hband()
-        self.data["bb_low"] = bb.bollinger_lband()
-
-        self.data["stdev"] = df["close"].rolling(self.window).std()
-        self.data["vwap"] = volume_weighted_average_price(
-            high=df["high"],
-            low=df["low"],
-            close=df["close"],
-            volume=df["volume"],
-            window=self.window,
-        )
-        self.data["vwap_vhigh"] = self.data["vwap"] + 2 * self.data["stdev"]
-        self.data["vwap_high"] = self.data["vwap"] + 1 * self.data["stdev"]
-        self.data["vwap_low"] = self.data["vwap"] - 1 * self.data["stdev"]
-        self.data["vwap_vlow"] = self.data["vwap"] - 2 * self.data["stdev"]
+        block = self.indicators.run_block(df)
+        for column, values in zip(self.columns, block.T):
+            self.data[column] = values
+
+        if self.journaled:
+            # the final row of every column, as a single slice of the block
+            self.latest = block[-1]
 
-    def show_chart(self):
+    def chart_payload(self, indicators):
         df = self.data.astype(
             {
                 "open": "float",
@@ -126,56 +132,24 @@ class PinkyTracker:
                 "close": "float",
                 "volume": "float",
             }
-        )  # again :()
-
-        extras = [
-
-
-            # mpf.make_addplot(
-            #     self.data["bb_high"], color="lime", panel=0, secondary_y=False
-            # ),
-            # mpf.make_addplot(
-            #     self.data["bb_low"], color="gold", panel=0, secondary_y=False
-            # ),
-
-            mpf.make_addplot(
-                self.data["vwap"], color="blueviolet", panel=0, secondary_y=False
-            ),
-
-            mpf.make_addplot(
-                self.data["vwap_vhigh"], color="royalblue", panel=0, secondary_y=False
-            ),
-            mpf.make_addplot(
-                self.data["vwap_high"], color="deepskyblue", panel=0, secondary_y=False
-            ),
-            mpf.make_addplot(
-                self.data["vwap_low"], color="darkorange", panel=0, secondary_y=False
-            ),
-            mpf.make_addplot(
-                self.data["vwap_vlow"], color="orangered", panel=0, secondary_y=False
-            ),
-        ]
-
-        fig, axes = mpf.plot(
-            df,
-            type="candle",
-            addplot=extras,
-            title=f"{self.base_symbol}/{self.quote_symbol}",
-            # volume=True,
-            figsize=(13, 8),
-            tight_layout=True,
-            style="yahoo",
-            xrotation=0,
-            returnfig=True,
         )
 
-        for ax in axes:
-            ax.yaxis.tick_left()
-            ax.yaxis.label.set_visible(False)
-            ax.margins(x=0.1, y=0.1, tight=False)
-
-        plt.savefig(f"{self.base_symbol}_{self.quote_symbol}.png", bbox_inches="tight", pad_inches=0.3, dpi=300)
-        plt.close()
+        return dict(
+            symbol=self.base_symbol + self.quote_symbol,
+            title=f"{self.base_symbol}/{self.quote_symbol}",
+            close_time=int(df["close_time"].iloc[-1].timestamp()) * 1000,
+            time=df.index.to_numpy(),
+            open=df["open"].to_numpy(),
+            high=df["high"].to_numpy(),
+            low=df["low"].to_numpy(),
+            close=df["close"].to_numpy(),
+            volume=df["volume"].to_numpy(),
+            indicators={
+                name: df[name].to_numpy(dtype=float)
+                for name in indicators
+                if name in df
+            },
+        )
 
     def compute_triggers(self):
         price = self.price
@@ -207,40 +181,57 @@ class PinkyTracker:
         return MarketSignal.HOLD
 
     def backtest(self):
-        pre_signal = None
-        for i, row in self.data.iterrows():
-            price = float(row["close"])
-            high = row["bb_high"]
-            low = row["bb_low"]
-            high_velocity = row["high_velocity"]
-            low_velocity = row["low_velocity"]
-
-            signal = None
-            if pre_signal == MarketSignal.SELL and high_velocity <= 0:
-                pre_signal = None
-                signal = MarketSignal.SELL
-            elif pre_signal == MarketSignal.BUY and low_velocity >= 0:
-                pre_signal = None
-                signal = MarketSignal.BUY
-
-            if price >= high:
-                if high_velocity > 0:
-                    pre_signal = MarketSignal.SELL
-                else:
-                    pre_signal = None
-                    signal = MarketSignal.SELL
-            elif price <= low:
-                if low_velocity < 0:
-                    pre_signal = MarketSignal.BUY
-                else:
-                    pre_signal = None
-                    signal = MarketSignal.BUY
+        pre_signals, signals = replay_signals(
+            self.data["close"].astype(float),
+            self.data["bb_high"],
+            self.data["bb_low"],
+            self.data["high_velocity"],
+            self.data["low_velocity"],
+        )
 
+        for pre_signal, signal, (i, row) in zip(
+            pre_signals, signals, self.data.iterrows()
+        ):
             print(
                 row["close_time"].isoformat(),
                 pre_signal,
                 signal,
-                price,
-                low_velocity,
+                float(row["close"]),
+                row["low_velocity"],
                 row["low"],
             )
+
+
+def replay_signals(close, bb_high, bb_low, high_velocity, low_velocity):
+    """Replays the triggers over whole columns, returning the pre_signal and
+    signal (or None) seen after every candle."""
+    pre_signal = None
+    pre_signals, signals = list(), list()
+    for price, high, low, high_velocity, low_velocity in zip(
+        close, bb_high, bb_low, high_velocity, low_velocity
+    ):
+        signal = None
+        if pre_signal == MarketSignal.SELL and high_velocity <= 0:
+            pre_signal = None
+            signal = MarketSignal.SELL
+        elif pre_signal == MarketSignal.BUY and low_velocity >= 0:
+            pre_signal = None
+            signal = MarketSignal.BUY
+
+        if price >= high:
+            if high_velocity > 0:
+                pre_signal = MarketSignal.SELL
+            else:
+                pre_signal = None
+                signal = MarketSignal.SELL
+        elif price <= low:
+            if low_velocity < 0:
+                pre_signal = MarketSignal.BUY
+            else:
+                pre_signal = None
+                signal = MarketSignal.BUY
+
+        pre_signals.append(pre_signal)
+        signals.append(signal)
+
+    return pre_signals, signals
@@ -0,0 +1,134 @@
+import cProfile
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+"""
+Profiling switched on at runtime, either by `kill -USR1` or by creating the
+control file (optionally holding the number of cycles), for the next few
+pre_tick / tick cycles. Every (symbol, stage) pair gets its own cProfile
+stats, readable by pstats or snakeviz, and a tracemalloc snapshot is dumped
+after every cycle. While disarmed, `stage()` hands out a shared null context.
+"""
+PROFILED_CYCLES = 5
+CONTROL_FILE = "profile.request"
+
+DISARMED = nullcontext()
+
+
+class TickProfiler:
+    def __init__(self, folder="./profiles", control_file=CONTROL_FILE):
+        self.folder = folder
+        self.control_file = control_file
+
+        self.armed = 0
+        self.active = False
+        self.cycles_left = 0
+        self.cycle = 0
+
+        self.profiles = dict()
+        self.timings = dict()
+
+    def listen(self, signum=signal.SIGUSR1):
+        signal.signal(signum, lambda *_: self.arm())
+
+    def arm(self, cycles=PROFILED_CYCLES):
+        self.armed = max(cycles, 1)
+
+    def poll(self):
+        if not os.path.isfile(self.control_file):
+            return
+
+        with open(self.control_file, "rt") as control:
+            content = control.read().strip()
+        os.remove(self.control_file)
+        self.arm(int(content) if content.isdigit() else PROFILED_CYCLES)
+
+    def begin_cycle(self):
+        if not self.active:
+            self.poll()
+            if not self.armed:
+                return
+
+            self.cycles_left, self.armed = self.armed, 0
+            self.cycle = 0
+            self.profiles.clear()
+            self.timings.clear()
+            self.stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            os.makedirs(os.path.join(self.folder, self.stamp), exist_ok=True)
+            tracemalloc.start(8)
+            self.active = True
+            print(f"Profiling the next {self.cycles_left} cycles.")
+
+        self.cycle += 1
+
+    def end_cycle(self):
+        if not self.active:
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(self.output(f"cycle-{self.cycle}.snapshot"))
+
+        self.cycles_left -= 1
+        if self.cycles_left <= 0:
+            tracemalloc.stop()
+            self.active = False
+            self.dump()
+
+    def stage(self, symbol: str, stage: str):
+        if not self.active:
+            return DISARMED
+        return self.measure(symbol, stage)
+
+    @contextmanager
+    def measure(self, symbol: str, stage: str):
+        key = symbol, stage
+        profile = self.profiles.setdefault(key, cProfile.Profile())
+        memory_before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            memory_after, _ = tracemalloc.get_traced_memory()
+
+            # net change of the traced memory, freed blocks offset new ones
+            calls, total, net_traced = self.timings.get(key, (0, 0.0, 0))
+            self.timings[key] = (
+                calls + 1,
+                total + elapsed,
+                net_traced + memory_after - memory_before,
+            )
+
+    def output(self, name: str) -> str:
+        return os.path.join(self.folder, self.stamp, name)
+
+    def dump(self):
+        combined = None
+        for (symbol, stage), profile in self.profiles.items():
+            profile.dump_stats(self.output(f"{symbol}.{stage}.prof"))
+            if combined is None:
+                combined = pstats.Stats(profile)
+            else:
+                combined.add(profile)
+        if combined is not None:
+            combined.dump_stats(self.output("all.prof"))
+
+        with open(self.output("stages.tsv"), "wt") as summary:
+            summary.write("symbol\tstage\tcalls\tseconds\tnet_traced_bytes\n")
+            for (symbol, stage), (calls, total, net_traced) in sorted(
+                self.timings.items(), key=lambda x: -x[1][1]
+            ):
+                summary.write(
+                    f"{symbol}\t{stage}\t{calls}\t{total:.6f}\t{net_traced}\n"
+                )
+
+        print(f"Profiles written to {os.path.join(self.folder, self.stamp)}")
+        self.profiles.clear()
@@ -0,0 +1,109 @@
+import time
+
+import pandas as pd
+
+"""
+Two stage screening of the whole market.
+The first stage ranks every pair of the value asset from a single bulk 24h
+ticker call, by how much it swings and how much it trades. Only the top
+ranked pairs are promoted to full trackers, which keeps the cost of the tick
+bounded no matter how many pairs the market lists. Promoted pairs linger for
+a while after dropping out of the top, and when there is no room left, the
+one that has been out of the top the longest makes way for a better one.
+"""
+SCREENED_PAIRS = 10
+SCREEN_INTERVAL = 15 * 60
+SCREEN_LINGER = 60 * 60
+MIN_QUOTE_VOLUME = 10000
+
+
+class MarketScreener:
+    # a sentinel, so that no account name can ever hold pairs on its behalf
+    HOLDER = object()
+
+    def __init__(
+        self,
+        market,
+        size=SCREENED_PAIRS,
+        linger=SCREEN_LINGER,
+        min_quote_volume=MIN_QUOTE_VOLUME,
+    ):
+        self.market = market
+        self.size = size
+        self.linger = linger
+        self.min_quote_volume = min_quote_volume
+
+        self.promoted = dict()
+        self.scores = dict()
+
+    def rank(self) -> pd.Series:
+        """Scores every tradable pair of the value asset, best first."""
+        tickers = pd.DataFrame(self.market.client.ticker_24hr(type="MINI"))
+        tickers = tickers[
+            tickers["symbol"].isin(self.market.tradable)
+            & tickers["symbol"].map(
+                lambda x: self.market.all_symbols.get(x, (None, None))[1]
+                == self.market.value_asset
+            )
+        ]
+        if tickers.empty:
+            return pd.Series(dtype=float)
+
+        tickers = tickers.astype(
+            {
+                "highPrice": "float",
+                "lowPrice": "float",
+                "lastPrice": "float",
+                "quoteVolume": "float",
+            }
+        )
+        tickers = tickers[
+            (tickers["quoteVolume"] >= self.min_quote_volume)
+            & (tickers["lastPrice"] > 0)
+        ]
+
+        volatility = (tickers["highPrice"] - tickers["lowPrice"]) / tickers["lastPrice"]
+        score = volatility.rank(pct=True) + tickers["quoteVolume"].rank(pct=True)
+        score.index = tickers["symbol"]
+        return score.sort_values(ascending=False)
+
+    def screen(self):
+        now = time.monotonic()
+        self.market.update_tradable()
+        ranking = self.rank()
+        self.scores = ranking.to_dict()
+        top = list(ranking.index[: self.size])
+
+        for symbol in top:
+            if symbol in self.promoted:
+                self.promoted[symbol] = now
+
+        # drop whatever stayed out of the top for too long
+        for symbol, last_top in list(self.promoted.items()):
+            if now - last_top > self.linger or symbol not in self.scores:
+                self.evict(symbol)
+
+        for symbol in top:
+            if symbol in self.promoted:
+                continue
+            if len(self.promoted) >= self.size:
+                victim = min(
+                    self.promoted,
+                    key=lambda x: (self.promoted[x], self.scores.get(x, 0)),
+                )
+                if self.scores.get(victim, 0) >= self.scores[symbol]:
+                    continue
+                self.evict(victim)
+            self.promote(symbol, now)
+
+    def promote(self, symbol: str, now: float):
+        self.promoted[symbol] = now
+        self.market.subscribe(symbol, self.HOLDER)
+
+    def evict(self, symbol: str):
+        self.promoted.pop(symbol, None)
+        self.market.unsubscribe(symbol, self.HOLDER)
+
+    @property
+    def symbols(self):
+        return self.promoted.keys()
@@ -64,3 +64,50 @@ def make_telegram_client() -> TelegramNotifier:
 
     notifier = TelegramNotifier(**dict(credentials.items("telegram")))
     return notifier
+
+
+def account_sections(credentials: configparser.ConfigParser, prefix: str) -> dict:
+    """Maps account names to their sections, `[prefix]` being the unnamed one
+    and `[prefix.name]` any additional account."""
+    sections = dict()
+    for section in credentials.sections():
+        if section == prefix:
+            sections[""] = section
+        elif section.startswith(prefix + "."):
+            sections[section[len(prefix) + 1 :]] = section
+    return sections
+
+
+def make_accounts(go_live: bool = False) -> list:
+    if not os.path.isfile(CREDENTIALS_CACHE):
+        # let the single account factories write the empty template
+        make_binance_client() if go_live else make_binance_test_client()
+
+    credentials = configparser.ConfigParser()
+    credentials.read(CREDENTIALS_CACHE)
+
+    prefix = "binance" if go_live else "binance-test"
+    options = dict() if go_live else dict(base_url="https://testnet.binance.vision")
+
+    accounts = list()
+    notifiers = dict()
+    for name, section in sorted(account_sections(credentials, prefix).items()):
+        client = Spot(**dict(credentials.items(section)), **options)
+
+        # named accounts inherit the bot token, but may route to their own chat
+        telegram = dict()
+        if credentials.has_section("telegram"):
+            telegram.update(credentials.items("telegram"))
+        if name and credentials.has_section(f"telegram.{name}"):
+            telegram.update(credentials.items(f"telegram.{name}"))
+
+        # accounts routed to the same chat share one notifier
+        chat = telegram.get("token"), telegram.get("chat_id")
+        if chat not in notifiers:
+            notifiers[chat] = TelegramNotifier(**telegram)
+        notifier = notifiers[chat]
+
+        accounts.append((name, client, notifier))
+
+    assert accounts, f"No [{prefix}] account found in {CREDENTIALS_CACHE}"
+    return accounts